@@ -2,20 +2,25 @@
 # ✅ ClickGuardian — versión estable funcional
 # ======================================================
 
-from flask import Flask, request, jsonify, render_template
+import time
+_BOOT_T0 = time.perf_counter()
+
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, g
 from flask_cors import CORS
 from datetime import datetime, timezone, timedelta
-from collections import deque, defaultdict
+from collections import deque, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import lru_cache
-import requests, re, logging
+from itertools import islice, count
+import requests, re, logging, threading, math
+from requests.adapters import HTTPAdapter
+from array import array
 from ipaddress import ip_network, ip_address
-from google.ads.googleads.client import GoogleAdsClient
-from google.ads.googleads.errors import GoogleAdsException
-import json, os
+import json, os, csv, io, gzip, queue
 
 
 
-import hashlib
+import hashlib, uuid
 
 
 def get_account_for_domain(domain: str):
@@ -40,6 +45,12 @@ HIGH_RISK_KEYWORDS = {
 
 STORAGE_FILE = "storage.json"
 
+# Pre-warm opcional del geo cache (0 = apagado)
+PREWARM_GEO_IPS = int(os.environ.get("CG_PREWARM_GEO", "0"))
+PREWARM_TIMEOUT = float(os.environ.get("CG_PREWARM_TIMEOUT", "10"))
+RECENT_IPS_PERSISTED = 500
+SAVE_LOCK = threading.RLock()   # reentrante: el bulk aplica + guarda bajo el mismo lock
+
 KNOWN_DATACENTERS = [
     "aws", "amazon", "google cloud", "gcp", "azure",
     "microsoft", "ovh", "digitalocean", "contabo",
@@ -61,6 +72,9 @@ def load_storage():
         BLOCK_RANGES.update(data.get("block_ranges", []))
         WHITELIST_DEVICES.update(data.get("whitelist_devices", []))
         WHITELIST_IPS.update(data.get("whitelist_ips", []))
+        RECENT_IPS[:] = data.get("recent_ips", [])
+        BLOCK_META.update(data.get("block_meta", {}))
+        REPUTATION.load(data.get("reputation", {}))
 
         # Restauramos settings si existen
         saved_settings = data.get("settings", {})
@@ -75,17 +89,31 @@ def load_storage():
 
 
 def save_storage():
+    # Antes de cargar, los sets están vacíos: escribir borraría storage.json
+    if not STORAGE_READY.is_set():
+        logging.warning("⚠️ save_storage ignorado: storage aún no cargado")
+        return
+
     try:
-        data = {
-            "block_devices": list(BLOCK_DEVICES),
-            "block_ips": list(BLOCK_IPS),
-            "block_ranges": list(BLOCK_RANGES),
-            "whitelist_devices": list(WHITELIST_DEVICES),
-            "whitelist_ips": list(WHITELIST_IPS),
-            "settings": SETTINGS
-        }
-        with open(STORAGE_FILE, "w") as f:
-            json.dump(data, f, indent=2)
+        # Foto + escritura atómica (tmp + replace) bajo el lock: nunca un lote a medias
+        with SAVE_LOCK:
+            data = {
+                "block_devices": list(BLOCK_DEVICES),
+                "block_ips": list(BLOCK_IPS),
+                "block_ranges": list(BLOCK_RANGES),
+                "whitelist_devices": list(WHITELIST_DEVICES),
+                "whitelist_ips": list(WHITELIST_IPS),
+                "recent_ips": list(RECENT_IPS),
+                "block_meta": dict(BLOCK_META),
+                "reputation": REPUTATION.dump(),
+                "settings": SETTINGS
+            }
+            tmp = STORAGE_FILE + ".tmp"
+            # Sin indent: json usa el encoder en C (con reputación el archivo crece)
+            raw = json.dumps(data)
+            with open(tmp, "w") as f:
+                f.write(raw)
+            os.replace(tmp, STORAGE_FILE)
 
 
         logging.info("💾 Storage guardado exitosamente")
@@ -120,20 +148,44 @@ CORS(app,
 # ✅ Estado global
 
 EVENTS = deque(maxlen=30000)
+# seq monotónico asignado al entrar en EVENTS (el panel hace polling por seq);
+# BOOT_ID cambia en cada arranque → el panel sabe que la secuencia reinició
+EVENTS_LOCK = threading.Lock()
+EVENT_SEQ = count(1)
+BOOT_ID = uuid.uuid4().hex[:12]
 
 BLOCK_DEVICES = set()
 BLOCK_IPS     = set()
 BLOCK_RANGES  = set()
 
+# Metadatos de bloqueo ("device:x", "ip:y", "range:z") → auto/since/expires
+# Sin entrada = bloqueo manual permanente
+BLOCK_META = {}
+
 WHITELIST_DEVICES = set()
 WHITELIST_IPS     = set()
 
+# IPs más frecuentes persistidas (para pre-warm del geo cache)
+RECENT_IPS = []
+
+# Índice de rangos: (versión, prefijo) → set de redes (int desplazado)
+RANGE_INDEX = {}
+
+# Readiness: storage + índice de rangos / geo cache caliente
+STORAGE_READY = threading.Event()
+GEO_WARM = threading.Event()
+BOOT_TIMINGS = {}
+
 LAST_SEEN_DEVICE = defaultdict(deque)
 LAST_SEEN_IP     = defaultdict(deque)
 
 LAST_DWELL_DEVICE = {}
 LAST_DWELL_IP     = {}
 
+# Último fingerprint (hash del cliente) por device; FIFO acotado
+DEVICE_FP = {}
+DEVICE_FP_MAX = 50000
+
 
 SETTINGS = {
     "risk_autoblock": True,
@@ -143,7 +195,25 @@ SETTINGS = {
     "fast_dwell_ms": 350,         # antes 450 (ok)
     "fast_repeat_required": 6,    # antes 3 (subo a 6)
     "min_good_dwell_ms": 2200,    # era 2000 (normal)
-    "good_dwell_window_minutes": 8 # era 5 (subo)
+    "good_dwell_window_minutes": 8, # era 5 (subo)
+
+    # Heavy hitters (clusters que rotan device/IP). 0 = solo observar
+    "hh_autoblock": True,
+    "hh_window_seconds": 60,
+    "hh_prefix_required": 12,     # mismo /24 (IPv4) o /48 (IPv6)
+    "hh_asn_required": 0,
+    "hh_ua_required": 0,
+    "hh_fp_required": 0,          # fp_hash del cliente (o screen + tz)
+    "hh_keyword_required": 0,
+
+    # Reputación con decaimiento + desbloqueo automático
+    "rep_half_life_minutes": 60,
+    "rep_block_score": 0,         # 0 = solo observar (sin ajustar aún)
+    "rep_min_risk": 30,           # solo suma el riesgo por encima de esto
+    "rep_unblock_score": 20,      # solo expiran autobloqueos que tenían ≥ esto al bloquear
+    "rep_min_block_minutes": 30,
+    "rep_floor": 1,               # por debajo se compacta
+    "rep_sweep_seconds": 60
 }
 
 
@@ -153,8 +223,18 @@ BOT_UA_PAT = re.compile(
 )
 
 # ✅ Helpers
+
+# Reloj único de las decisiones (replay.py lo congela en el ts capturado)
+def push_event(ev: dict):
+    with EVENTS_LOCK:
+        ev["seq"] = next(EVENT_SEQ)
+        EVENTS.append(ev)
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
 def now_iso():
-    return datetime.now(timezone.utc).isoformat()
+    return utcnow().isoformat()
 
 def get_client_ip():
     h = request.headers
@@ -167,118 +247,379 @@ def get_client_ip():
         return xff.split(",")[0].strip()
     return request.remote_addr
 
+def _range_key(net):
+    bits = net.max_prefixlen - net.prefixlen
+    return (net.version, net.prefixlen), int(net.network_address) >> bits
+
+# Copy-on-write: los lectores nunca ven el índice a medio construir;
+# los escritores se serializan con RANGE_LOCK y publican con un solo assign
+RANGE_LOCK = threading.Lock()
+
+def _index_range(index: dict, r: str):
+    try:
+        key, value = _range_key(ip_network(r, strict=False))
+    except ValueError:
+        logging.warning(f"⚠️ Rango inválido ignorado: {r}")
+        return
+    index.setdefault(key, set()).add(value)
+
+def rebuild_range_index():
+    global RANGE_INDEX
+    with RANGE_LOCK:
+        index = {}
+        for r in list(BLOCK_RANGES):
+            _index_range(index, r)
+        RANGE_INDEX = index
+
+def add_range_to_index(r: str):
+    global RANGE_INDEX
+    with RANGE_LOCK:
+        index = {k: set(v) for k, v in RANGE_INDEX.items()}
+        _index_range(index, r)
+        RANGE_INDEX = index
+
+def add_block_range(r: str):
+    BLOCK_RANGES.add(r)
+    add_range_to_index(r)
+
 def is_ip_in_blocked_range(ip: str):
     try:
         ip_obj = ip_address(ip)
-        for r in BLOCK_RANGES:
-            if ip_obj in ip_network(r):
-                return True
-    except:
-        pass
+    except ValueError:
+        return False
+    value = int(ip_obj)
+    index = RANGE_INDEX  # snapshot: nunca se muta después de publicado
+    for (version, prefixlen), nets in index.items():
+        if version == ip_obj.version and (value >> (ip_obj.max_prefixlen - prefixlen)) in nets:
+            return True
     return False
 
-@lru_cache(maxsize=20000)
-def geo_lookup(ip: str):
-    """Geo Lookup Inteligente con 3 APIs + fusión de ciudad más probable"""
+def remove_block_range(r: str):
+    BLOCK_RANGES.discard(r)
+    rebuild_range_index()
 
-    # 🔥 1. Localhost o redes internas
-    if not ip or ip.startswith(("127.", "10.", "192.168.", "::1")):
-        return {
-            "country": "LOCAL",
-            "region": "-",
-            "city": "Local",
-            "district": "-",
-            "isp": "LAN",
-            "asn": "-",
-            "lat": 0,
-            "lon": 0,
-            "vpn": False
-        }
+def recent_top_ips(limit: int, scan: int = 5000):
+    """IPs más frecuentes entre los últimos `scan` eventos"""
+    counter = Counter(ev.get("ip") for ev in islice(reversed(EVENTS), scan) if ev.get("ip"))
+    return [ip for ip, _ in counter.most_common(limit)]
 
-    results = []
+def refresh_recent_ips(limit: int = RECENT_IPS_PERSISTED):
+    # Tras un reinicio EVENTS está casi vacío: completar con las cargadas
+    top = recent_top_ips(limit)
+    if len(top) < limit:
+        seen = set(top)
+        top += [ip for ip in RECENT_IPS if ip not in seen][:limit - len(top)]
+    RECENT_IPS[:] = top
 
-    # ================================
-    # API 1 → ipwho.is
-    # ================================
-    try:
-        r1 = requests.get(f"https://ipwho.is/{ip}", timeout=2).json()
-        results.append({
-            "city": r1.get("city"),
-            "region": r1.get("region"),
-            "country": r1.get("country"),
-            "isp": (r1.get("connection") or {}).get("isp") or r1.get("org"),
-            "asn": (r1.get("connection") or {}).get("asn"),
-            "lat": r1.get("latitude"),
-            "lon": r1.get("longitude"),
-            "vpn": (r1.get("security") or {}).get("vpn", False)
-        })
-    except:
-        pass
+# ======================================================
+# 🌎 Geo providers — circuit breaker + stats + hedging
+# ======================================================
 
-    # ================================
-    # API 2 → ipapi.co
-    # ================================
-    try:
-        r2 = requests.get(f"https://ipapi.co/{ip}/json/", timeout=2).json()
-        results.append({
-            "city": r2.get("city"),
-            "region": r2.get("region"),
-            "country": r2.get("country_name"),
-            "isp": r2.get("org"),
-            "asn": r2.get("asn"),
-            "lat": r2.get("latitude"),
-            "lon": r2.get("longitude"),
-            "vpn": False  # ipapi no devuelve vpn
-        })
-    except:
-        pass
+GEO_TIMEOUT = 2          # timeout HTTP por proveedor
+GEO_DEADLINE = 2.5       # tiempo máximo total de geo_lookup
+GEO_HEDGE_MIN = 0.15     # nunca lanzar el segundo antes de esto
+GEO_HEDGE_MAX = 1.0
+GEO_FUSION_GRACE = 0.05  # espera extra por un segundo proveedor ya en vuelo
+
+GEO_EMPTY = {
+    "city": "-",
+    "region": "-",
+    "country": "-",
+    "isp": "-",
+    "asn": "-",
+    "lat": 0,
+    "lon": 0,
+    "vpn": False
+}
 
-    # ================================
-    # API 3 → ipinfo.io  (sin token usa datos libres)
-    # ================================
-    try:
-        r3 = requests.get(f"https://ipinfo.io/{ip}/json", timeout=2).json()
-        loc = (r3.get("loc") or "0,0").split(",")
-
-        results.append({
-            "city": r3.get("city"),
-            "region": r3.get("region"),
-            "country": r3.get("country"),
-            "isp": r3.get("org"),
-            "asn": None,
-            "lat": float(loc[0]),
-            "lon": float(loc[1]),
-            "vpn": False
-        })
-    except:
-        pass
 
-    # ================================
-    # Si todas fallan
-    # ================================
-    if not results:
+def _parse_ipwho(r):
+    if r.get("success") is False:
+        raise ValueError(r.get("message") or "ipwho.is error")
+    return {
+        "city": r.get("city"),
+        "region": r.get("region"),
+        "country": r.get("country"),
+        "isp": (r.get("connection") or {}).get("isp") or r.get("org"),
+        "asn": (r.get("connection") or {}).get("asn"),
+        "lat": r.get("latitude"),
+        "lon": r.get("longitude"),
+        "vpn": (r.get("security") or {}).get("vpn", False)
+    }
+
+
+def _parse_ipapi(r):
+    if r.get("error"):
+        raise ValueError(r.get("reason") or "ipapi.co error")
+    return {
+        "city": r.get("city"),
+        "region": r.get("region"),
+        "country": r.get("country_name"),
+        "isp": r.get("org"),
+        "asn": r.get("asn"),
+        "lat": r.get("latitude"),
+        "lon": r.get("longitude"),
+        "vpn": False  # ipapi no devuelve vpn
+    }
+
+
+def _parse_ipinfo(r):
+    # sin token usa datos libres
+    if r.get("error"):
+        raise ValueError("ipinfo.io error")
+    loc = (r.get("loc") or "0,0").split(",")
+    return {
+        "city": r.get("city"),
+        "region": r.get("region"),
+        "country": r.get("country"),
+        "isp": r.get("org"),
+        "asn": None,
+        "lat": float(loc[0]),
+        "lon": float(loc[1]),
+        "vpn": False
+    }
+
+
+class GeoProvider:
+    """Un proveedor + su circuit breaker y estadísticas móviles"""
+
+    FAILURES_TO_OPEN = 3
+    COOLDOWN_MIN = 30
+    COOLDOWN_MAX = 600
+
+    def __init__(self, name: str, url: str, parse):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.lock = threading.Lock()
+
+        self.samples = deque(maxlen=50)   # (latencia, ok)
+        self.ewma = None
+        self.failures = 0
+        self.state = "closed"
+        self.open_until = 0.0
+        self.cooldown = self.COOLDOWN_MIN
+        self.probing = False
+
+    def available(self, now: float) -> bool:
+        if self.state == "closed":
+            return True
+        return now >= self.open_until and not self.probing
+
+    def allow(self, now: float) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and now >= self.open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.probing:
+                self.probing = True   # una sola petición de prueba
+                return True
+            return False
+
+    def record(self, latency: float, ok: bool, now: float):
+        with self.lock:
+            self.samples.append((latency, ok))
+            # Los timeouts también cuentan: un proveedor lento baja en el ranking
+            self.ewma = latency if self.ewma is None else 0.8 * self.ewma + 0.2 * latency
+            if ok:
+                self.failures = 0
+                self.state = "closed"
+                self.cooldown = self.COOLDOWN_MIN
+            else:
+                self.failures += 1
+                if self.state == "half_open" or self.failures >= self.FAILURES_TO_OPEN:
+                    if self.state == "half_open":
+                        self.cooldown = min(self.COOLDOWN_MAX, self.cooldown * 2)
+                    self.state = "open"
+                    self.open_until = now + self.cooldown
+            self.probing = False
+
+    def release(self):
+        # Probe reservado pero cancelado antes de salir: el siguiente puede probar
+        with self.lock:
+            self.probing = False
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+    def latency_p90(self):
+        lat = sorted(l for l, ok in self.samples if ok)
+        if not lat:
+            return None
+        return lat[min(len(lat) - 1, int(len(lat) * 0.9))]
+
+    def rank(self) -> float:
+        base = self.ewma if self.ewma is not None else 0.3
+        return base * (1 + 3 * self.error_rate())
+
+    def snapshot(self) -> dict:
         return {
-            "city": "-",
-            "region": "-",
-            "country": "-",
-            "isp": "-",
-            "asn": "-",
-            "lat": 0,
-            "lon": 0,
-            "vpn": False
+            "state": self.state,
+            "ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "p90_ms": round(self.latency_p90() * 1000, 1) if self.latency_p90() is not None else None,
+            "error_rate": round(self.error_rate(), 3),
+            "samples": len(self.samples),
+            "open_for_s": round(max(0.0, self.open_until - time.time()), 1) if self.state == "open" else 0
         }
 
-    # ================================
-    # FUSIÓN INTELIGENTE
-    # Elegir ciudad más repetida (o la que no sea None)
-    # ================================
+
+class GeoProviderManager:
+    """
+    Elige el proveedor sano más rápido; si tarda más que su p90
+    lanza el siguiente (hedged request). Sesión HTTP compartida con keep-alive.
+    """
+
+    def __init__(self, providers, session=None, max_workers: int = 16):
+        self.providers = providers
+        # ×2: con el pool lleno el primario corre en el hilo de la request
+        self.session = session or self._make_session(2 * max_workers)
+        self.max_workers = max_workers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cg-geo")
+        self.active = 0   # en cola + en vuelo
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _make_session(pool_size: int):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def ranked(self, now: float):
+        healthy = [p for p in self.providers if p.available(now)]
+        return sorted(healthy, key=lambda p: p.rank())
+
+    def _call(self, provider: GeoProvider, ip: str):
+        t0 = time.monotonic()
+        try:
+            r = self.session.get(provider.url.format(ip=ip), timeout=GEO_TIMEOUT)
+            r.raise_for_status()
+            out = provider.parse(r.json())
+        except Exception as e:
+            provider.record(time.monotonic() - t0, False, time.time())
+            logging.debug(f"geo {provider.name} falló: {e}")
+            return None
+        provider.record(time.monotonic() - t0, True, time.time())
+        return out
+
+    def saturated(self) -> bool:
+        return self.active >= self.max_workers
+
+    def _submit(self, provider: GeoProvider, ip: str):
+        with self.lock:
+            self.active += 1
+        f = self.pool.submit(self._call, provider, ip)
+        f.add_done_callback(lambda f: self._finished(f, provider))
+        return f
+
+    def _finished(self, f, provider: GeoProvider):
+        with self.lock:
+            self.active -= 1
+        if f.cancelled():
+            provider.release()
+
+    @staticmethod
+    def _hedge_delay(provider: GeoProvider) -> float:
+        p90 = provider.latency_p90()
+        if p90 is None:
+            return GEO_HEDGE_MAX
+        return max(GEO_HEDGE_MIN, min(GEO_HEDGE_MAX, p90))
+
+    def query(self, ip: str) -> list:
+        order = self.ranked(time.time())
+        if not order:
+            return []
+
+        deadline = time.monotonic() + GEO_DEADLINE
+        pending = {}
+        results = []
+        nxt = 0
+
+        def launch():
+            # Pool lleno: ni hedge ni reintento, no se encola trabajo que nadie espera
+            nonlocal nxt
+            if self.saturated():
+                return
+            while nxt < len(order):
+                p = order[nxt]
+                nxt += 1
+                # allow() reserva el probe si el breaker está half-open
+                if p.allow(time.time()):
+                    pending[self._submit(p, ip)] = p
+                    return
+
+        if self.saturated():
+            # Primario en el hilo de la request (su timeout HTTP < GEO_DEADLINE)
+            for p in order:
+                if p.allow(time.time()):
+                    out = self._call(p, ip)
+                    return [out] if out else []
+            return []
+
+        launch()
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = min(remaining, self._hedge_delay(order[nxt - 1])) if nxt < len(order) else remaining
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                launch()   # el actual va lento → hedge
+                continue
+
+            for f in done:
+                pending.pop(f)
+                if f.result():
+                    results.append(f.result())
+
+            if results:
+                # Si otro ya está en vuelo, un instante más para poder fusionar
+                if pending:
+                    wait(pending, timeout=max(0.0, min(GEO_FUSION_GRACE, deadline - time.monotonic())))
+                for f in [f for f in pending if f.done()]:
+                    if f.result():
+                        results.append(f.result())
+                break
+
+            launch()   # falló → siguiente sin esperar
+
+        # Lo que siga en cola ya no le sirve a nadie
+        for f in pending:
+            f.cancel()
+        return results
+
+    def snapshot(self) -> dict:
+        return {p.name: p.snapshot() for p in self.providers}
+
+
+GEO_PROVIDERS = GeoProviderManager([
+    GeoProvider("ipwho.is", "https://ipwho.is/{ip}", _parse_ipwho),
+    GeoProvider("ipapi.co", "https://ipapi.co/{ip}/json/", _parse_ipapi),
+    GeoProvider("ipinfo.io", "https://ipinfo.io/{ip}/json", _parse_ipinfo),
+])
+
+
+def fuse_geo(results: list) -> dict:
+    """FUSIÓN INTELIGENTE: valor más repetido por campo (solo con ≥ 2 respuestas)"""
+    if not results:
+        return dict(GEO_EMPTY)
+
+    if len(results) == 1:
+        only = results[0]
+        return {k: (only.get(k) if only.get(k) is not None else GEO_EMPTY[k]) for k in GEO_EMPTY}
+
     def most_common(field):
         vals = [r.get(field) for r in results if r.get(field)]
         if not vals:
             return "-"
         return max(set(vals), key=vals.count)
 
-    fused = {
+    return {
         "city": most_common("city"),
         "region": most_common("region"),
         "country": most_common("country"),
@@ -289,14 +630,48 @@ def geo_lookup(ip: str):
         "vpn": any([r.get("vpn") for r in results])
     }
 
-    return fused
+
+class _GeoMiss(Exception):
+    """Ningún proveedor respondió (o todos con breaker abierto)"""
+
+
+@lru_cache(maxsize=20000)
+def _geo_cached(ip: str) -> dict:
+    # lru_cache no guarda excepciones: un fallo total no queda pegado como GEO_EMPTY
+    results = GEO_PROVIDERS.query(ip)
+    if not results:
+        raise _GeoMiss(ip)
+    return fuse_geo(results)
+
+
+def geo_lookup(ip: str):
+    """Geo Lookup con proveedor adaptativo + fusión cuando responden 2 o más"""
+
+    # 🔥 1. Localhost o redes internas
+    if not ip or ip.startswith(("127.", "10.", "192.168.", "::1")):
+        return {
+            "country": "LOCAL",
+            "region": "-",
+            "city": "Local",
+            "district": "-",
+            "isp": "LAN",
+            "asn": "-",
+            "lat": 0,
+            "lon": 0,
+            "vpn": False
+        }
+
+    try:
+        return _geo_cached(ip)
+    except _GeoMiss:
+        return dict(GEO_EMPTY)
 
 def _prune_window(dq: deque, cutoff: datetime):
     while dq and dq[0] < cutoff:
         dq.popleft()
 
 def count_recent(dq: deque, seconds: int) -> int:
-    cutoff = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+    cutoff = utcnow() - timedelta(seconds=seconds)
     _prune_window(dq, cutoff)
     return len(dq)
 
@@ -307,7 +682,7 @@ def touches_in_window_ip(ip: str, seconds: int):
     return count_recent(LAST_SEEN_IP[ip], seconds)
 
 def had_good_dwell_recently(device_id: str, minutes: int, min_ms: int) -> bool:
-    cutoff = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+    cutoff = utcnow() - timedelta(minutes=minutes)
 
     for ev in reversed(EVENTS):
         if ev.get("device_id") != device_id:
@@ -322,6 +697,322 @@ def had_good_dwell_recently(device_id: str, minutes: int, min_ms: int) -> bool:
             return True
 
     return False
+
+# ======================================================
+# 🔥 Heavy hitters — Count-Min Sketch + Space-Saving
+# Memoria constante sin importar cuántas IPs/devices lleguen
+# ======================================================
+
+HH_DIMENSIONS = ("prefix", "asn", "ua", "fp", "keyword")
+
+
+class CountMinSketch:
+    """Contador aproximado (sobreestima, nunca subestima)"""
+
+    def __init__(self, width: int = 1024, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("I", bytes(4 * width)) for _ in range(depth)]
+
+    def _indexes(self, key: str):
+        h = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        h1 = int.from_bytes(h[:4], "little")
+        h2 = int.from_bytes(h[4:], "little") | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key: str, n: int = 1) -> int:
+        # Conservative update: solo sube las celdas que están en el mínimo
+        idx = self._indexes(key)
+        est = min(row[i] for row, i in zip(self.rows, idx)) + n
+        for row, i in zip(self.rows, idx):
+            if row[i] < est:
+                row[i] = est
+        return est
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+    def clear(self):
+        self.rows = [array("I", bytes(4 * self.width)) for _ in range(self.depth)]
+
+
+class SpaceSaving:
+    """Top-k aproximado con k contadores fijos"""
+
+    def __init__(self, capacity: int = 32):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, key: str, n: int = 1):
+        if key in self.counts:
+            self.counts[key] += n
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = n
+        else:
+            # Reemplaza al mínimo heredando su cuenta (error acotado)
+            victim = min(self.counts, key=self.counts.get)
+            self.counts[key] = self.counts.pop(victim) + n
+
+    def clear(self):
+        self.counts.clear()
+
+
+class HeavyHitterTracker:
+    """
+    Ventanas deslizantes por dimensión:
+    - anillo de CMS en slots cortos → conteo del cluster en repeat window
+    - anillo de Space-Saving por minuto → top ofensores últimos N minutos
+    """
+
+    def __init__(self, slot_seconds: int = 10, cms_slots: int = 36,
+                 top_minutes: int = 60, width: int = 1024, depth: int = 4,
+                 top_k: int = 32):
+        self.slot_seconds = slot_seconds
+        self.cms_slots = cms_slots
+        self.top_minutes = top_minutes
+        self.lock = threading.Lock()
+
+        self._cms = {d: [[-1, CountMinSketch(width, depth)] for _ in range(cms_slots)]
+                     for d in HH_DIMENSIONS}
+        self._top = {d: [[-1, SpaceSaving(top_k)] for _ in range(top_minutes)]
+                     for d in HH_DIMENSIONS}
+
+    @staticmethod
+    def _slot(ring, slot_id: int):
+        # Rotación perezosa: si el slot es de otra vuelta, se limpia
+        entry = ring[slot_id % len(ring)]
+        if entry[0] != slot_id:
+            entry[0] = slot_id
+            entry[1].clear()
+        return entry[1]
+
+    def observe(self, keys: dict, ts: float, window_seconds: int) -> dict:
+        """Suma 1 a cada clave y devuelve su cuenta en la ventana"""
+        cms_id = int(ts // self.slot_seconds)
+        top_id = int(ts // 60)
+        n_slots = max(1, min(self.cms_slots, -(-int(window_seconds) // self.slot_seconds)))
+
+        out = {}
+        with self.lock:
+            for dim, key in keys.items():
+                if not key:
+                    continue
+                ring = self._cms[dim]
+                self._slot(ring, cms_id).add(key)
+                self._slot(self._top[dim], top_id).add(key)
+
+                total = 0
+                for sid in range(cms_id - n_slots + 1, cms_id + 1):
+                    entry = ring[sid % len(ring)]
+                    if entry[0] == sid:
+                        total += entry[1].estimate(key)
+                out[dim] = total
+        return out
+
+    def top(self, minutes: int, limit: int = 10, ts: float = None) -> dict:
+        ts = utcnow().timestamp() if ts is None else ts
+        top_id = int(ts // 60)
+        minutes = max(1, min(self.top_minutes, int(minutes)))
+
+        out = {}
+        with self.lock:
+            for dim in HH_DIMENSIONS:
+                merged = defaultdict(int)
+                ring = self._top[dim]
+                for sid in range(top_id - minutes + 1, top_id + 1):
+                    entry = ring[sid % len(ring)]
+                    if entry[0] == sid:
+                        for k, c in entry[1].counts.items():
+                            merged[k] += c
+                best = sorted(merged.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+                out[dim] = [{"key": k, "count": c} for k, c in best]
+        return out
+
+
+HEAVY_HITTERS = HeavyHitterTracker()
+
+
+def ip_prefix(ip: str):
+    """/24 para IPv4, /48 para IPv6"""
+    try:
+        obj = ip_address(ip)
+        bits = 24 if obj.version == 4 else 48
+        return str(ip_network(f"{ip}/{bits}", strict=False))
+    except Exception:
+        return None
+
+
+def heavy_hitter_keys(ev: dict) -> dict:
+    geo = ev.get("geo") or {}
+    ua = (ev.get("ua") or "").strip()
+    screen = (ev.get("screen") or "").strip()
+    tz = (ev.get("tz") or "").strip()
+    asn = geo.get("asn")
+    fp = ev.get("fp_hash") or (f"{screen}|{tz}" if screen and tz else None)
+
+    return {
+        "prefix": ip_prefix(ev.get("ip") or ""),
+        "asn": str(asn) if asn and asn != "-" else None,
+        "ua": hashlib.sha1(ua.encode("utf-8")).hexdigest()[:16] if ua else None,
+        "fp": fp,
+        "keyword": (ev.get("keyword") or "").lower().strip() or None,
+    }
+
+
+def heavy_hitter_trigger(counts: dict):
+    """Devuelve la primera dimensión que supera su umbral (o None)"""
+    for dim in HH_DIMENSIONS:
+        required = SETTINGS.get(f"hh_{dim}_required") or 0
+        if required > 0 and counts.get(dim, 0) >= required:
+            return dim
+    return None
+
+
+# ======================================================
+# 📉 Reputación con decaimiento exponencial
+# device / IP / prefijo / ASN — O(1) por evento (decay perezoso)
+# ======================================================
+
+class ReputationStore:
+    """Scores que se reducen a la mitad cada rep_half_life_minutes"""
+
+    def __init__(self):
+        self.entries = {}   # key → (score, ts)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _decay(score: float, ts: float, now: float) -> float:
+        half_life = max(1.0, float(SETTINGS["rep_half_life_minutes"]) * 60)
+        return score * math.exp(-math.log(2) * max(0.0, now - ts) / half_life)
+
+    def bump(self, key: str, amount: float, now: float) -> float:
+        with self.lock:
+            score, ts = self.entries.get(key, (0.0, now))
+            score = self._decay(score, ts, now) + amount
+            self.entries[key] = (score, now)
+            return score
+
+    def score(self, key: str, now: float) -> float:
+        entry = self.entries.get(key)
+        if not entry:
+            return 0.0
+        return self._decay(entry[0], entry[1], now)
+
+    def compact(self, now: float, floor: float) -> int:
+        with self.lock:
+            dead = [k for k, (s, ts) in self.entries.items() if self._decay(s, ts, now) < floor]
+            for k in dead:
+                del self.entries[k]
+            return len(dead)
+
+    def dump(self) -> dict:
+        with self.lock:
+            return {k: [s, ts] for k, (s, ts) in self.entries.items()}
+
+    def load(self, data: dict):
+        with self.lock:
+            for k, v in data.items():
+                try:
+                    self.entries[k] = (float(v[0]), float(v[1]))
+                except (TypeError, ValueError, IndexError):
+                    continue
+
+
+REPUTATION = ReputationStore()
+
+
+def bump_reputation(ev: dict, now: float) -> dict:
+    """Suma el score de riesgo del evento a cada entidad y devuelve los scores"""
+    geo = ev.get("geo") or {}
+    asn = geo.get("asn")
+    keys = {
+        "device": ev.get("device_id"),
+        "ip": ev.get("ip"),
+        "prefix": ip_prefix(ev.get("ip") or ""),
+        "asn": str(asn) if asn and asn != "-" else None,
+    }
+    # La base de tráfico normal (TZ, país ≠ CO) queda por debajo del piso
+    score = (ev.get("risk") or {}).get("score") or 0
+    amount = max(0, score - SETTINGS["rep_min_risk"])
+
+    out = {}
+    for kind, value in keys.items():
+        if not value:
+            out[kind] = 0.0
+            continue
+        key = f"{kind}:{value}"
+        score = REPUTATION.bump(key, amount, now) if amount else REPUTATION.score(key, now)
+        out[kind] = round(score, 1)
+    return out
+
+
+def _rep_key(key: str) -> str:
+    # "range:x" se respalda con la reputación de "prefix:x"
+    return "prefix:" + key[len("range:"):] if key.startswith("range:") else key
+
+
+def mark_autoblock(key: str, reason: str, now: float = None):
+    """Bloqueo automático: guarda la reputación del momento (solo entradas nuevas)"""
+    meta = BLOCK_META.get(key)
+    if meta and (meta.get("expires") or not meta.get("auto")):
+        return  # manual o con TTL explícito: no se convierte en auto
+    now = now or utcnow().timestamp()
+    BLOCK_META[key] = {
+        "auto": True,
+        "since": now,
+        "reason": reason,
+        "rep": round(REPUTATION.score(_rep_key(key), now), 1)
+    }
+
+
+def unblock_key(key: str):
+    kind, _, value = key.partition(":")
+    if kind == "device":
+        BLOCK_DEVICES.discard(value)
+    elif kind == "ip":
+        BLOCK_IPS.discard(value)
+    elif kind == "range":
+        remove_block_range(value)
+    BLOCK_META.pop(key, None)
+
+
+def _block_expired(key: str, meta: dict, now: float) -> bool:
+    expires = meta.get("expires")
+    if expires:
+        return now >= expires
+    if not meta.get("auto"):
+        return False
+    # Solo expira lo que la reputación respaldaba: una regla con score 0 no "decae"
+    if (meta.get("rep") or 0) < SETTINGS["rep_unblock_score"]:
+        return False
+    if now - meta.get("since", now) < SETTINGS["rep_min_block_minutes"] * 60:
+        return False
+    return REPUTATION.score(_rep_key(key), now) < SETTINGS["rep_unblock_score"]
+
+
+def sweep_expired(now: float = None) -> dict:
+    """Desbloquea entradas vencidas y compacta estructuras en memoria"""
+    now = now or utcnow().timestamp()
+
+    unblocked = [k for k, meta in list(BLOCK_META.items()) if _block_expired(k, meta, now)]
+    for k in unblocked:
+        unblock_key(k)
+
+    compacted = REPUTATION.compact(now, SETTINGS["rep_floor"])
+
+    # Ventanas de repetición vacías
+    cutoff = datetime.fromtimestamp(now, timezone.utc) - timedelta(seconds=SETTINGS["repeat_window_seconds"])
+    for table in (LAST_SEEN_DEVICE, LAST_SEEN_IP):
+        for k, dq in list(table.items()):
+            _prune_window(dq, cutoff)
+            if not dq:
+                table.pop(k, None)
+
+    if unblocked:
+        logging.info(f"⏳ Desbloqueados por TTL/reputación: {len(unblocked)}")
+    return {"unblocked": unblocked, "compacted": compacted}
+
+
 def compute_risk(ev: dict):
     score = 0
     reasons = []
@@ -439,6 +1130,191 @@ def compute_risk(ev: dict):
     }
 
 
+# ======================================================
+# 🚦 Arranque: readiness gate + warm-up en segundo plano
+# ======================================================
+
+GATED_ENDPOINTS = {"track", "track_fp", "guard_check"}
+MUTATING_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+def _elapsed_ms():
+    return round((time.perf_counter() - _BOOT_T0) * 1000, 1)
+
+@app.before_request
+def readiness_gate():
+    g.t0 = time.perf_counter()
+    g.t_arrival = utcnow().timestamp()   # la captura guarda la llegada, no el fin
+    if "first_request_ms" not in BOOT_TIMINGS:
+        BOOT_TIMINGS["first_request_ms"] = _elapsed_ms()
+
+    # Decidir o mutar sin blocklists cargadas sería dejar pasar todo
+    # (o pisar storage.json con sets vacíos)
+    gated = request.endpoint in GATED_ENDPOINTS or request.method in MUTATING_METHODS
+    if gated and request.method != "OPTIONS" and not STORAGE_READY.wait(5):
+        return jsonify({"ok": False, "error": "storage cargando, reintenta"}), 503
+
+def prewarm_geo_cache(limit: int):
+    ips = RECENT_IPS[:limit]
+    if not ips:
+        return 0
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(geo_lookup, ip) for ip in ips]
+        done, _ = wait(futures, timeout=PREWARM_TIMEOUT)
+        for f in futures:
+            f.cancel()
+    return len(done)
+
+def warm_up():
+    t0 = time.perf_counter()
+    load_storage()
+    rebuild_range_index()
+    BOOT_TIMINGS["storage_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    STORAGE_READY.set()
+    threading.Thread(target=sweeper_loop, name="cg-sweeper", daemon=True).start()
+
+    if PREWARM_GEO_IPS > 0:
+        t0 = time.perf_counter()
+        warmed = prewarm_geo_cache(PREWARM_GEO_IPS)
+        BOOT_TIMINGS["prewarm_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        BOOT_TIMINGS["prewarm_ips"] = warmed
+    GEO_WARM.set()
+
+    BOOT_TIMINGS["ready_ms"] = _elapsed_ms()
+    logging.info(f"🚀 Warm-up listo: {BOOT_TIMINGS}")
+
+def sweeper_loop():
+    while True:
+        time.sleep(max(5, SETTINGS["rep_sweep_seconds"]))
+        try:
+            # Fuera de track(): el Counter sobre 5000 eventos no va en cada autobloqueo
+            refresh_recent_ips()
+            result = sweep_expired()
+            if result["unblocked"]:
+                save_storage()
+        except Exception as e:
+            logging.error(f"❌ Error en sweeper: {e}")
+
+def start_warm_up():
+    threading.Thread(target=warm_up, name="cg-warmup", daemon=True).start()
+
+@app.get("/healthz")
+def healthz():
+    # Proceso vivo (no depende de storage)
+    return jsonify({"ok": True})
+
+@app.get("/readyz")
+def readyz():
+    ready = STORAGE_READY.is_set() and GEO_WARM.is_set()
+    body = {
+        "ready": ready,
+        "storage": STORAGE_READY.is_set(),
+        "geo_warm": GEO_WARM.is_set(),
+        "timings": BOOT_TIMINGS
+    }
+    if RECORDER:
+        body["capture"] = RECORDER.stats()
+    return jsonify(body), (200 if ready else 503)
+
+# ======================================================
+# 🎥 Captura de tráfico (/track, /guard) → JSONL.gz rotativo
+# Se reproduce con replay.py
+# ======================================================
+
+CAPTURE_DIR = os.environ.get("CG_CAPTURE_DIR", "")
+CAPTURE_MAX_BYTES = int(float(os.environ.get("CG_CAPTURE_MAX_MB", "50")) * 1024 * 1024)
+CAPTURE_KEEP = int(os.environ.get("CG_CAPTURE_KEEP", "20"))   # total en el dir (≥ nº de workers)
+CAPTURE_MAX_BODY = 16384
+
+# Lo que usa get_client_ip + contexto mínimo
+CAPTURE_HEADERS = ("CF-Connecting-IP", "True-Client-IP", "X-Real-IP", "X-Forwarded-For", "User-Agent", "Origin")
+
+
+class TrafficRecorder:
+    """La request solo paga un put_nowait; un hilo comprime y escribe"""
+
+    def __init__(self, directory: str, max_bytes: int, keep: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = max(1, keep)
+        self._seq = 0
+        self.queue = queue.Queue(maxsize=20000)
+        self.written = 0
+        self.dropped = 0
+        self._file = None
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._run, name="cg-capture", daemon=True).start()
+
+    def record(self, entry: dict):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _rotate(self):
+        if self._file:
+            self._file.close()
+        # pid + secuencia: dos rotaciones en el mismo segundo no se pisan
+        self._seq += 1
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        name = f"capture-{stamp}-{os.getpid()}-{self._seq:05d}.jsonl.gz"
+        self._file = gzip.open(os.path.join(self.directory, name), "xt", encoding="utf-8")
+        self._bytes = 0
+        self._prune()
+
+    def _prune(self):
+        # Retención: los `keep` más recientes del dir (incluye workers ya muertos)
+        files = []
+        for f in os.listdir(self.directory):
+            if f.startswith("capture-"):
+                try:
+                    files.append((os.path.getmtime(os.path.join(self.directory, f)), f))
+                except OSError:
+                    pass  # otro worker lo borró
+        for _, old in sorted(files)[:-self.keep]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                if self._file is None or self._bytes >= self.max_bytes:
+                    self._rotate()
+                line = json.dumps(entry, ensure_ascii=False) + "\n"
+                self._file.write(line)
+                self._bytes += len(line)
+                self.written += 1
+                # Sync flush cuando no hay más en cola: el archivo es legible en caliente
+                if self.queue.empty():
+                    self._file.flush()
+            except Exception as e:
+                logging.error(f"❌ Error escribiendo captura: {e}")
+
+    def stats(self) -> dict:
+        return {"written": self.written, "dropped": self.dropped, "queued": self.queue.qsize()}
+
+
+RECORDER = TrafficRecorder(CAPTURE_DIR, CAPTURE_MAX_BYTES, CAPTURE_KEEP) if CAPTURE_DIR else None
+
+@app.after_request
+def capture_traffic(response):
+    if RECORDER and request.endpoint in GATED_ENDPOINTS and request.method == "POST":
+        RECORDER.record({
+            "t": g.t_arrival if "t_arrival" in g else utcnow().timestamp(),
+            "path": request.path,
+            "headers": {k: v for k, v in ((k, request.headers.get(k)) for k in CAPTURE_HEADERS) if v},
+            "remote_addr": request.remote_addr,
+            "body": request.get_data(cache=True, as_text=True)[:CAPTURE_MAX_BODY],
+            "status": response.status_code,
+            "ms": round((time.perf_counter() - g.t0) * 1000, 2) if "t0" in g else None
+        })
+    return response
+
+
+
 @app.route("/guard", methods=["POST", "OPTIONS"])
 def guard_check():
     if request.method == "OPTIONS":
@@ -470,6 +1346,9 @@ def push_ip_to_google_ads(ip: str, domain: str = ""):
     try:
         customer_id = get_account_for_domain(domain)
 
+        # Import perezoso: el SDK de Google Ads es pesado y casi no se usa
+        from google.ads.googleads.client import GoogleAdsClient
+
         # Cargar Google Ads client
         client = GoogleAdsClient.load_from_storage(
             "/root/clikguardian/google-ads.yaml"
@@ -498,6 +1377,25 @@ def push_ip_to_google_ads(ip: str, domain: str = ""):
     except Exception as e:
         logging.error(f"❌ Error bloqueando IP en Google Ads: {e}")
 
+def remember_fp(device_id: str, fp_hash) -> str:
+    fp_hash = str(fp_hash or "").strip()[:64]
+    if device_id and fp_hash:
+        DEVICE_FP.pop(device_id, None)
+        DEVICE_FP[device_id] = fp_hash
+        if len(DEVICE_FP) > DEVICE_FP_MAX:
+            DEVICE_FP.pop(next(iter(DEVICE_FP)), None)
+    return fp_hash
+
+@app.route("/track/fp", methods=["POST", "OPTIONS"])
+def track_fp():
+    # Hash fresco calculado después del land (sendBeacon)
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    data = request.get_json(force=True, silent=True) or {}
+    remember_fp((data.get("device_id") or "").strip(), data.get("fp_hash"))
+    return ("", 204)
+
 @app.route("/track", methods=["POST", "OPTIONS"])
 def track():
     if request.method == "OPTIONS":
@@ -513,10 +1411,10 @@ def track():
     # ------------------------------------------------------
     device_id = (data.get("device_id") or "").strip()
     if not device_id:
-        EVENTS.append(data)
+        push_event(data)
         return ("", 204)
 
-    now = datetime.now(timezone.utc)
+    now = utcnow()
     LAST_SEEN_IP[ip].append(now)
     if device_id:
         LAST_SEEN_DEVICE[device_id].append(now)
@@ -535,10 +1433,22 @@ def track():
     data["device_id"] = device_id
     data["ts"] = now_iso()
     data["geo"] = geo
+    # El land sale con el hash cacheado (o sin él); luego vale el último conocido
+    data["fp_hash"] = remember_fp(device_id, data.get("fp_hash")) or DEVICE_FP.get(device_id)
     data["last_dwell_device"] = last_dwell_dev
     data["last_dwell_ip"] = last_dwell_ip
     data["risk"] = compute_risk(data)
 
+    # 🔥 Heavy hitters por cluster (/24, ASN, UA, fingerprint, keyword)
+    hh_counts = HEAVY_HITTERS.observe(
+        heavy_hitter_keys(data), now.timestamp(), SETTINGS["hh_window_seconds"]
+    )
+    data["heavy_hitters"] = hh_counts
+
+    # 📉 Reputación acumulada (device, IP, /24, ASN)
+    rep_scores = bump_reputation(data, now.timestamp())
+    data["reputation"] = rep_scores
+
     # Actualizar dwell
     if device_id and dwell:
         LAST_DWELL_DEVICE[device_id] = dwell
@@ -559,7 +1469,7 @@ def track():
     # Si IP pertenece a rango ya bloqueado → fuera
     if is_ip_in_blocked_range(ip):
         data["autoblocked"] = {"by": "range", "reason": "blocked_range"}
-        EVENTS.append(data)
+        push_event(data)
         return ("", 403)
     # 🔥 Bloqueo por ASN + ISP tipo VPN/Datacenter
     asn = geo.get("asn")
@@ -570,14 +1480,18 @@ def track():
             parts = ip.split(".")
             if len(parts) == 4:
                 range_24 = f"{parts[0]}.{parts[1]}.{parts[2]}.0/24"
-                BLOCK_RANGES.add(range_24)
+                if range_24 not in BLOCK_RANGES:
+                    add_block_range(range_24)
+                    mark_autoblock(f"range:{range_24}", "datacenter")
         except:
             pass
 
-        BLOCK_IPS.add(ip)
+        if ip not in BLOCK_IPS:
+            BLOCK_IPS.add(ip)
+            mark_autoblock(f"ip:{ip}", "datacenter")
         data["autoblocked"] = {"by": "asn", "reason": "datacenter"}
         save_storage()
-        EVENTS.append(data)
+        push_event(data)
         return ("", 403)
 
     # ------------------------------------------------------
@@ -589,20 +1503,26 @@ def track():
     # Whitelist = permitir siempre
     if device_id in WHITELIST_DEVICES or ip in WHITELIST_IPS:
         data["blocked"] = False
-        EVENTS.append(data)
+        push_event(data)
         return ("", 204)
 
     autoblock = False
     reason_ab = None
 
+    # Cluster que rota device/IP pero supera su umbral
+    hh_dim = heavy_hitter_trigger(hh_counts) if SETTINGS["hh_autoblock"] else None
+
     # No bloquear solo por land, necesitamos patrón
     if evt_type != "land" and SETTINGS["risk_autoblock"] and data["risk"]["suspicious"]:
         autoblock = True
         reason_ab = "risk"
 
-    # Si NO hay repetición, no bloquear
+    # Si NO hay repetición (ni cluster caliente), no bloquear
     if repeats < SETTINGS["repeat_required"]:
-        autoblock = False
+        if autoblock and hh_dim:
+            reason_ab = f"risk_hh_{hh_dim}"
+        else:
+            autoblock = False
 
     # 2️⃣ WhatsApp pero repetido sospechoso
     if evt_type == "whatsapp_click" and repeats >= SETTINGS["repeat_required"]:
@@ -614,28 +1534,63 @@ def track():
     if evt_type != "whatsapp_click" and dwell < SETTINGS["fast_dwell_ms"] and repeats >= SETTINGS["fast_repeat_required"]:
         autoblock = True
         reason_ab = "fast_repeats"
+    elif evt_type != "whatsapp_click" and dwell and dwell < SETTINGS["fast_dwell_ms"] and hh_dim:
+        autoblock = True
+        reason_ab = f"fast_hh_{hh_dim}"
 
     # 4️⃣ ISP sospechoso
     if any(dc in isp for dc in KNOWN_DATACENTERS):
         autoblock = True
         reason_ab = "isp_datacenter"
+
+    # 5️⃣ Sospecha gradual: cada score solo bloquea a su propia entidad
+    rep_block = SETTINGS["rep_block_score"]
+    rep_block_ip = False
+    if not autoblock and rep_block > 0 and evt_type != "land":
+        if rep_scores["device"] >= rep_block:
+            autoblock = True
+            reason_ab = "reputation"
+        elif rep_scores["ip"] >= rep_block:
+            rep_block_ip = True
     # ------------------------------------------------------
     # 🔥 Bloqueo final
     # ------------------------------------------------------
     if autoblock:
         if device_id:
-            BLOCK_DEVICES.add(device_id)
+            # Ya bloqueado (p. ej. a mano) → no tocar su metadata
+            if device_id not in BLOCK_DEVICES:
+                BLOCK_DEVICES.add(device_id)
+                mark_autoblock(f"device:{device_id}", reason_ab)
             data["autoblocked"] = {"by": "device", "reason": reason_ab}
         else:
-            BLOCK_IPS.add(ip)
+            if ip not in BLOCK_IPS:
+                BLOCK_IPS.add(ip)
+                mark_autoblock(f"ip:{ip}", reason_ab)
             data["autoblocked"] = {"by": "ip", "reason": reason_ab}
 
+        # Cluster caliente: el device rota, se bloquea lo que no rota (IP y /24 o /48)
+        if hh_dim and reason_ab.endswith(f"_hh_{hh_dim}"):
+            if ip not in BLOCK_IPS:
+                BLOCK_IPS.add(ip)
+                mark_autoblock(f"ip:{ip}", reason_ab)
+            prefix = ip_prefix(ip) if hh_dim == "prefix" else None
+            if prefix and prefix not in BLOCK_RANGES:
+                add_block_range(prefix)
+                mark_autoblock(f"range:{prefix}", reason_ab)
+            data["autoblocked"].update({"ip": ip, "range": prefix})
+
+        save_storage()
+    elif rep_block_ip:
+        if ip not in BLOCK_IPS:
+            BLOCK_IPS.add(ip)
+            mark_autoblock(f"ip:{ip}", "reputation")
+        data["autoblocked"] = {"by": "ip", "reason": "reputation"}
         save_storage()
     else:
         data["autoblocked"] = False
 
     data["blocked"] = (device_id in BLOCK_DEVICES) or (ip in BLOCK_IPS)
-    EVENTS.append(data)
+    push_event(data)
 
     return ("", 204)
 
@@ -644,8 +1599,19 @@ def track():
 @app.get("/api/events")
 def api_events():
     limit = int(request.args.get("limit", 200))
-    evs = list(EVENTS)[-limit:]
-    evs.reverse()
+    after = request.args.get("after", type=int)
+
+    with EVENTS_LOCK:
+        last_seq = EVENTS[-1]["seq"] if EVENTS else 0
+        if after is not None:
+            # Incremental por seq: EVENTS está en orden de seq (no de ts)
+            evs = []
+            for ev in reversed(EVENTS):
+                if ev["seq"] <= after or len(evs) >= limit:
+                    break
+                evs.append(ev)
+        else:
+            evs = list(islice(reversed(EVENTS), limit))
 
     out = []
     for ev in evs:
@@ -659,7 +1625,7 @@ def api_events():
             "blocked_by": "device" if blocked_device else ("ip" if blocked_ip else None)
         })
 
-    return jsonify({"events": out})
+    return jsonify({"events": out, "last_seq": last_seq, "boot": BOOT_ID})
 
 @app.get("/api/blocklist")
 def get_blocklist():
@@ -677,6 +1643,7 @@ def add_block_device():
     if not d:
         return jsonify({"ok": False, "error": "device_id requerido"}), 400
     BLOCK_DEVICES.add(d)
+    BLOCK_META.pop(f"device:{d}", None)
     save_storage()
     return jsonify({"ok": True, "blocked": d})
 
@@ -691,6 +1658,7 @@ def remove_block_device():
     # 1) Quitar del set de bloqueados
     if device_id in BLOCK_DEVICES:
         BLOCK_DEVICES.remove(device_id)
+        BLOCK_META.pop(f"device:{device_id}", None)
 
     # 2) Quitar dwell
         LAST_DWELL_DEVICE.pop(device_id, None)
@@ -709,6 +1677,7 @@ def add_block_ip():
     if not ip:
         return jsonify({"ok": False, "error": "ip requerida"}), 400
     BLOCK_IPS.add(ip)
+    BLOCK_META.pop(f"ip:{ip}", None)
     save_storage()
     return jsonify({"ok": True, "blocked": ip})
 
@@ -722,6 +1691,7 @@ def remove_block_ip():
 
     if ip in BLOCK_IPS:
         BLOCK_IPS.remove(ip)
+        BLOCK_META.pop(f"ip:{ip}", None)
         LAST_DWELL_IP.pop(ip, None)
         save_storage()
         return jsonify({"ok": True, "removed": ip})
@@ -729,6 +1699,218 @@ def remove_block_ip():
     return jsonify({"ok": False, "error": "ip no encontrada"}), 404
 
 
+# ======================================================
+# 📦 Bulk import / export de blocklist
+# NDJSON o CSV (type,value,ttl,reason,action) → un solo lote, una sola escritura
+# ======================================================
+
+BULK_MAX_ERRORS = 50
+
+def _parse_epoch(v):
+    if v in (None, ""):
+        return None
+    v = float(v)
+    if not math.isfinite(v) or v <= 0:
+        raise ValueError("timestamp inválido")
+    return v
+
+def normalize_block_entry(rec: dict, now: float):
+    """Valida y normaliza un registro → (kind, value, meta, action)"""
+    value = str(rec.get("value") or rec.get("ip") or rec.get("device_id") or rec.get("range") or "").strip()
+    if not value:
+        raise ValueError("value requerido")
+
+    kind = (rec.get("type") or "").strip().lower()
+    if not kind:
+        if "device_id" in rec:
+            kind = "device"
+        elif "/" in value:
+            kind = "range"
+        else:
+            try:
+                ip_address(value)
+                kind = "ip"
+            except ValueError:
+                kind = "device"
+
+    if kind == "ip":
+        value = str(ip_address(value))
+    elif kind == "range":
+        value = str(ip_network(value, strict=False))
+    elif kind != "device":
+        raise ValueError(f"type inválido: {kind}")
+
+    ttl = rec.get("ttl")
+    if ttl not in (None, ""):
+        ttl = float(ttl)
+        if not math.isfinite(ttl) or ttl <= 0:
+            raise ValueError("ttl debe ser un número > 0")
+        ttl = int(ttl)
+    else:
+        ttl = None
+
+    action = (rec.get("action") or "block").strip().lower()
+    if action not in ("block", "unblock"):
+        raise ValueError(f"action inválida: {action}")
+
+    # Mismas columnas que /api/blocklist/export: re-importar no pierde TTL ni auto
+    auto = str(rec.get("auto") or "").strip().lower() in ("1", "true", "yes")
+    expires = _parse_epoch(rec.get("expires"))
+    since = _parse_epoch(rec.get("since"))
+    rep = rec.get("rep")
+    rep = float(rep) if rep not in (None, "") else None
+
+    entry = {"auto": auto, "since": since or now}
+    if ttl:
+        entry["expires"] = now + ttl
+    elif expires:
+        entry["expires"] = expires
+    reason = (str(rec.get("reason") or "")).strip()
+    if reason:
+        entry["reason"] = reason
+    if auto and rep is not None and math.isfinite(rep):
+        entry["rep"] = rep
+    return kind, value, entry, action
+
+def iter_bulk_records(stream, fmt: str):
+    text = io.TextIOWrapper(stream, encoding="utf-8", errors="replace")
+    if fmt == "csv":
+        for row in csv.DictReader(text):
+            yield {k.strip().lower(): v for k, v in row.items() if k}
+        return
+    for line in text:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            rec = {"value": line}  # una IP/device por línea
+        if not isinstance(rec, dict):
+            rec = {"value": rec}
+        yield rec
+
+BLOCK_SETS = {"device": BLOCK_DEVICES, "ip": BLOCK_IPS, "range": BLOCK_RANGES}
+
+@app.post("/api/blocklist/bulk")
+def bulk_blocklist():
+    fmt = (request.args.get("format") or "").lower()
+    if not fmt:
+        fmt = "csv" if "csv" in (request.content_type or "") else "ndjson"
+    strict = request.args.get("strict") in ("1", "true")
+
+    # 1) Pasada streaming: validar y normalizar
+    add = {k: set() for k in BLOCK_SETS}
+    remove = {k: set() for k in BLOCK_SETS}
+    meta = {}
+    errors = []
+    invalid = 0
+    now = utcnow().timestamp()
+
+    for n, rec in enumerate(iter_bulk_records(request.stream, fmt), start=1):
+        try:
+            kind, value, entry, action = normalize_block_entry(rec, now)
+        except (ValueError, TypeError, OverflowError) as e:
+            invalid += 1
+            if len(errors) < BULK_MAX_ERRORS:
+                errors.append({"line": n, "error": str(e)})
+            continue
+
+        key = f"{kind}:{value}"
+        if action == "unblock":
+            remove[kind].add(value)
+            add[kind].discard(value)
+            meta.pop(key, None)
+            continue
+
+        add[kind].add(value)
+        remove[kind].discard(value)
+        meta[key] = entry
+
+    if strict and invalid:
+        return jsonify({"ok": False, "invalid": invalid, "errors": errors}), 400
+
+    # 2) Aplicar todo como un solo lote + 3) una sola escritura, bajo SAVE_LOCK:
+    #    un save_storage() concurrente (track, sweeper) nunca ve el lote a medias
+    with SAVE_LOCK:
+        for kind, target in BLOCK_SETS.items():
+            target.difference_update(remove[kind])
+            target.update(add[kind])
+            for value in remove[kind]:
+                BLOCK_META.pop(f"{kind}:{value}", None)
+
+        # Igual que DELETE /api/blockdevices y /api/blockips: olvidar el dwell previo
+        for value in remove["device"]:
+            LAST_DWELL_DEVICE.pop(value, None)
+        for value in remove["ip"]:
+            LAST_DWELL_IP.pop(value, None)
+        for key, entry in meta.items():
+            if entry["auto"] or "expires" in entry or "reason" in entry:
+                BLOCK_META[key] = entry
+            else:
+                BLOCK_META.pop(key, None)  # manual sin TTL = permanente
+
+        if add["range"] or remove["range"]:
+            rebuild_range_index()
+
+        save_storage()
+
+    return jsonify({
+        "ok": True,
+        "added": {k: len(v) for k, v in add.items()},
+        "removed": {k: len(v) for k, v in remove.items()},
+        "invalid": invalid,
+        "errors": errors
+    })
+
+@app.get("/api/blocklist/export")
+def export_blocklist():
+    """Export streaming con filtros (?type=ip,range&reason=&auto=0|1&format=ndjson|csv|txt)"""
+    fmt = (request.args.get("format") or "ndjson").lower()
+    kinds = [k.strip() for k in (request.args.get("type") or "device,ip,range").split(",") if k.strip() in BLOCK_SETS]
+    reason = request.args.get("reason")
+    auto = request.args.get("auto")
+
+    def rows():
+        for kind in kinds:
+            for value in list(BLOCK_SETS[kind]):
+                m = BLOCK_META.get(f"{kind}:{value}") or {}
+                if reason and m.get("reason") != reason:
+                    continue
+                if auto is not None and bool(m.get("auto")) != (auto in ("1", "true")):
+                    continue
+                yield {
+                    "type": kind,
+                    "value": value,
+                    "reason": m.get("reason"),
+                    "auto": bool(m.get("auto")),
+                    "expires": m.get("expires"),
+                    "since": m.get("since"),
+                    "rep": m.get("rep")
+                }
+
+    def generate():
+        if fmt == "txt":
+            for r in rows():
+                yield r["value"] + "\n"
+        elif fmt == "csv":
+            yield "type,value,reason,auto,expires,since,rep\r\n"
+            for r in rows():
+                # csv.writer: reasons con comas/comillas quedan bien citadas
+                buf = io.StringIO()
+                csv.writer(buf).writerow([
+                    r["type"], r["value"], r["reason"] or "", int(r["auto"]),
+                    r["expires"] or "", r["since"] or "", "" if r["rep"] is None else r["rep"]
+                ])
+                yield buf.getvalue()
+        else:
+            for r in rows():
+                yield json.dumps(r) + "\n"
+
+    mimetype = {"txt": "text/plain", "csv": "text/csv"}.get(fmt, "application/x-ndjson")
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
 @app.route("/del_block_device", methods=["POST"])
 def del_block_device():
     try:
@@ -804,6 +1986,31 @@ def asn_stats():
         counter[a] += 1
     return jsonify(counter)
 
+@app.get("/api/stats/geo_providers")
+def geo_provider_stats():
+    return jsonify(GEO_PROVIDERS.snapshot())
+
+@app.get("/api/stats/offenders")
+def offenders_stats():
+    """Top ofensores por dimensión en los últimos N minutos"""
+    minutes = int(request.args.get("minutes", 10))
+    limit = int(request.args.get("limit", 10))
+    return jsonify({
+        "minutes": minutes,
+        "top": HEAVY_HITTERS.top(minutes, limit)
+    })
+
+@app.get("/api/reputation")
+def api_reputation():
+    """Score actual (ya decaído) de un device / IP / prefijo / ASN"""
+    now = utcnow().timestamp()
+    out = {}
+    for kind in ("device", "ip", "prefix", "asn"):
+        value = request.args.get(kind, "").strip()
+        if value:
+            out[kind] = round(REPUTATION.score(f"{kind}:{value}", now), 1)
+    return jsonify({"scores": out, "tracked": len(REPUTATION.entries)})
+
 @app.get("/api/amiblocked")
 def api_am_i_blocked():
     device_id = request.args.get("device_id", "").strip()
@@ -826,8 +2033,9 @@ def device_stats():
     })
 
 
-# Cargar memoria persistente
-load_storage()
+# Cargar memoria persistente (sin bloquear el import)
+BOOT_TIMINGS["import_ms"] = _elapsed_ms()
+start_warm_up()
 
 # ✅ Run
 if __name__ == "__main__":
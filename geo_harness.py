@@ -0,0 +1,128 @@
+# ======================================================
+# 🧪 Harness local de proveedores geo falsos
+# Simula timeouts, caídas y rate-limit para probar breaker + hedging
+#
+#   python geo_harness.py
+# ======================================================
+
+import json, time, random, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+
+# Modo por proveedor: ("ok", latencia_s) | ("slow", s) | ("jitter", max_s) | ("down", 0) | ("ratelimit", 0)
+MODES = {}
+
+FAKE_BODIES = {
+    "ipwho": lambda ip: {"success": True, "city": "Bogotá", "region": "Bogota D.C.", "country": "Colombia",
+                         "connection": {"isp": "Claro", "asn": 10620}, "latitude": 4.6, "longitude": -74.1},
+    "ipapi": lambda ip: {"city": "Bogotá", "region": "Bogota D.C.", "country_name": "Colombia",
+                         "org": "Claro", "asn": "AS10620", "latitude": 4.6, "longitude": -74.1},
+    "ipinfo": lambda ip: {"city": "Bogota", "region": "Bogota", "country": "CO",
+                          "org": "AS10620 Claro", "loc": "4.6,-74.1"},
+}
+
+
+class FakeProvider(BaseHTTPRequestHandler):
+    def do_GET(self):
+        _, name, ip = self.path.split("/", 2)
+        mode, delay = MODES.get(name, ("ok", 0.05))
+
+        if mode == "down":
+            self.send_response(500)
+            self.end_headers()
+            return
+        if mode == "ratelimit":
+            body, status = {"error": True, "reason": "RateLimited"}, 429
+        else:
+            time.sleep(random.uniform(0.02, delay) if mode == "jitter" else delay)
+            body, status = FAKE_BODIES[name](ip), 200
+
+        raw = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        try:
+            self.wfile.write(raw)
+        except BrokenPipeError:
+            pass  # el cliente ya hizo timeout
+
+    def log_message(self, *args):
+        pass
+
+
+def make_manager(port: int):
+    base = f"http://127.0.0.1:{port}"
+    return app.GeoProviderManager([
+        app.GeoProvider("ipwho", base + "/ipwho/{ip}", app._parse_ipwho),
+        app.GeoProvider("ipapi", base + "/ipapi/{ip}", app._parse_ipapi),
+        app.GeoProvider("ipinfo", base + "/ipinfo/{ip}", app._parse_ipinfo),
+    ])
+
+
+def run(manager, label: str, n: int = 20):
+    lat, answers = [], []
+    for i in range(n):
+        t0 = time.perf_counter()
+        results = manager.query(f"181.50.0.{i}")
+        lat.append(time.perf_counter() - t0)
+        answers.append(len(results))
+    lat.sort()
+    print(f"\n▶ {label}")
+    print(f"  p50={lat[len(lat) // 2] * 1000:.0f}ms  max={lat[-1] * 1000:.0f}ms  "
+          f"fusionadas={sum(1 for a in answers if a >= 2)}/{n}  sin_respuesta={answers.count(0)}")
+    for name, snap in manager.snapshot().items():
+        print(f"  {name:7s} {snap}")
+
+
+def run_flood(manager, label: str, n: int = 40):
+    # n lookups simultáneos (> workers del pool): no debe quedar cola muerta
+    answers = []
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=lambda i=i: answers.append(len(manager.query(f"181.60.0.{i}"))))
+               for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f"\n▶ {label}")
+    print(f"  total={(time.perf_counter() - t0) * 1000:.0f}ms  con_respuesta={sum(1 for a in answers if a)}/{n}  "
+          f"en_vuelo={manager.active}  en_cola={manager.pool._work_queue.qsize()}")
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeProvider)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    # Timeouts cortos para que el harness corra rápido
+    app.GEO_TIMEOUT = 0.5
+    app.GEO_DEADLINE = 0.8
+
+    MODES.update(ipwho=("ok", 0.02), ipapi=("ok", 0.05), ipinfo=("ok", 0.08))
+    m = make_manager(port)
+    run(m, "todos sanos → un solo proveedor, el más rápido")
+
+    MODES["ipwho"] = ("slow", 2.0)
+    run(m, "ipwho lento → hedge al siguiente y baja en el ranking")
+
+    MODES["ipapi"] = ("ratelimit", 0)
+    run(m, "ipwho lento + ipapi rate-limited → solo ipinfo")
+
+    MODES.update(ipwho=("down", 0), ipapi=("down", 0), ipinfo=("down", 0))
+    run(m, "caída total → GEO_EMPTY sin pagar timeouts una vez abiertos", n=10)
+
+    MODES.update(ipwho=("jitter", 0.4), ipapi=("jitter", 0.4), ipinfo=("jitter", 0.4))
+    m = make_manager(port)
+    run(m, "latencia variable → hedge en la cola lenta, fusión si ambos responden", n=40)
+
+    MODES.update(ipwho=("slow", 0.4), ipapi=("slow", 0.4), ipinfo=("slow", 0.4))
+    m = make_manager(port)
+    run_flood(m, "ráfaga con todos lentos → sin hedge con el pool lleno, pendientes cancelados")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# ======================================================
+# 🔁 Replay determinista de capturas (/track, /guard)
+#
+#   CG_CAPTURE_DIR=captures gunicorn app:app        # capturar
+#   python replay.py run captures/*.jsonl.gz --speed max --out nuevo.jsonl
+#   python replay.py run captures/*.jsonl.gz --app-dir ../version_vieja --out viejo.jsonl
+#   python replay.py diff viejo.jsonl nuevo.jsonl
+#
+# Reloj congelado en el ts de cada request y geo simulado: misma captura
+# + mismo código = mismas decisiones, a cualquier velocidad.
+# ======================================================
+
+import argparse, gzip, heapq, json, os, sys, tempfile, time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+# Geo por defecto: tráfico residencial colombiano (no suma riesgo por país)
+DEFAULT_GEO = {
+    "city": "Bogota",
+    "region": "Bogota D.C.",
+    "country": "Colombia",
+    "isp": "Replay ISP",
+    "asn": "-",
+    "lat": 0,
+    "lon": 0,
+    "vpn": False
+}
+
+
+def read_capture(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            # Archivo aún abierto o cortado: se usa lo que haya
+            pass
+
+
+# El archivo se escribe al terminar cada request: "t" es la llegada, pero el
+# orden es el de fin. El desorden está acotado por la latencia (geo ≤ 2.5s)
+REORDER_SLACK = 30
+
+
+def reorder(entries, slack: float = REORDER_SLACK):
+    """Reordena por "t" con un buffer acotado a `slack` segundos"""
+    heap = []
+    for n, e in enumerate(entries):
+        heapq.heappush(heap, (e["t"], n, e))
+        while heap[0][0] <= e["t"] - slack:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def iter_entries(paths):
+    # Cada archivo se ordena por llegada; varios workers → merge por tiempo
+    return heapq.merge(*(reorder(read_capture(p)) for p in sorted(paths)), key=lambda e: e["t"])
+
+
+def load_app(app_dir: str, state: str):
+    # Entorno limpio: sin captura, sin pre-warm, sin storage.json del cwd
+    for var in ("CG_CAPTURE_DIR", "CG_PREWARM_GEO"):
+        os.environ.pop(var, None)
+    state = os.path.abspath(state) if state else None
+    sys.path.insert(0, os.path.abspath(app_dir))
+    os.chdir(tempfile.mkdtemp(prefix="cg-replay-"))
+
+    import app
+    if hasattr(app, "STORAGE_READY"):
+        app.STORAGE_READY.wait(10)
+    if state:
+        app.STORAGE_FILE = state
+        app.load_storage()
+        if hasattr(app, "rebuild_range_index"):
+            app.rebuild_range_index()
+        app.STORAGE_FILE = "storage.json"
+    return app
+
+
+def freeze(app, geo_map: dict):
+    clock = [datetime.now(timezone.utc)]
+    app.utcnow = lambda: clock[0]
+    app.geo_lookup = lambda ip: dict(geo_map.get(ip, DEFAULT_GEO))
+
+    # El sweeper de fondo usa reloj real; aquí se llama en tiempo de captura
+    sweep = getattr(app, "sweep_expired", None)
+    app.sweep_expired = lambda now=None: {"unblocked": [], "compacted": 0}
+    return clock, sweep
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def cmd_run(args):
+    geo_map = {}
+    if args.geo:
+        with open(args.geo) as f:
+            geo_map = json.load(f)
+    # load_app hace chdir: todas las rutas a absolutas antes
+    out_path = os.path.abspath(args.out)
+    captures = [os.path.abspath(p) for p in args.captures]
+    missing = [p for p in captures if not os.path.exists(p)]
+    if missing:
+        print(f"❌ No existe: {', '.join(missing)}")
+        return 2
+
+    app = load_app(args.app_dir, args.state)
+    clock, sweep = freeze(app, geo_map)
+    client = app.app.test_client()
+    speed = None if args.speed == "max" else float(args.speed)
+    sweep_every = app.SETTINGS.get("rep_sweep_seconds", 60)
+
+    latencies = defaultdict(list)
+    statuses = Counter()
+    autoblocks = Counter()
+    t0_capture = t0_wall = last_sweep = None
+
+    with open(out_path, "w") as out:
+        for i, e in enumerate(iter_entries(captures)):
+            if t0_capture is None:
+                t0_capture, t0_wall, last_sweep = e["t"], time.perf_counter(), e["t"]
+
+            # Ritmo: 1x / Nx respetan los huecos de la captura; max no espera
+            if speed:
+                ahead = (e["t"] - t0_capture) / speed - (time.perf_counter() - t0_wall)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+            clock[0] = datetime.fromtimestamp(e["t"], timezone.utc)
+            if sweep and e["t"] - last_sweep >= sweep_every:
+                sweep(e["t"])
+                last_sweep = e["t"]
+
+            last = app.EVENTS[-1] if app.EVENTS else None
+            t = time.perf_counter()
+            resp = client.post(
+                e["path"],
+                data=e.get("body") or "",
+                headers=e.get("headers") or {},
+                content_type="application/json",
+                environ_base={"REMOTE_ADDR": e.get("remote_addr") or "127.0.0.1"}
+            )
+            latencies[e["path"]].append((time.perf_counter() - t) * 1000)
+            statuses[resp.status_code] += 1
+
+            decision = {"i": i, "t": e["t"], "path": e["path"], "status": resp.status_code}
+            if app.EVENTS and app.EVENTS[-1] is not last:
+                ev = app.EVENTS[-1]
+                decision.update({
+                    "ip": ev.get("ip"),
+                    "device_id": ev.get("device_id"),
+                    "autoblocked": ev.get("autoblocked") or False,
+                    "score": (ev.get("risk") or {}).get("score")
+                })
+                if ev.get("autoblocked"):
+                    autoblocks[ev["autoblocked"].get("reason")] += 1
+            decision["captured_status"] = e.get("status")
+            out.write(json.dumps(decision, ensure_ascii=False) + "\n")
+
+    total = sum(len(v) for v in latencies.values())
+    wall = time.perf_counter() - t0_wall if t0_wall else 0.0
+    print(f"▶ {total} requests en {wall:.2f}s ({total / wall if wall else 0:.0f} req/s)")
+    for path, lat in sorted(latencies.items()):
+        print(f"  {path:8s} n={len(lat):6d}  p50={percentile(lat, .5):.2f}ms  p99={percentile(lat, .99):.2f}ms")
+    print(f"  status: {dict(statuses)}")
+    print(f"  autoblocks: {dict(autoblocks)}")
+    print(f"  decisiones → {out_path}")
+    return 0 if total else 1
+
+
+def load_decisions(path: str):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _reason(d):
+    ab = d.get("autoblocked")
+    return ab.get("reason") if isinstance(ab, dict) else None
+
+
+def cmd_diff(args):
+    a, b = load_decisions(args.a), load_decisions(args.b)
+    if not a or not b:
+        print(f"❌ Sin decisiones en {args.a if not a else args.b} (¿replay falló?)")
+        return 1
+    if len(a) != len(b):
+        print(f"⚠️ Largo distinto: {len(a)} vs {len(b)} (¿misma captura?)")
+
+    diffs = Counter()
+    shown = 0
+    for da, db in zip(a, b):
+        ra, rb = _reason(da), _reason(db)
+        if da["status"] == db["status"] and ra == rb:
+            continue
+        diffs[(da["status"], ra, db["status"], rb)] += 1
+        if shown < args.limit:
+            shown += 1
+            who = db.get("device_id") or db.get("ip") or "-"
+            print(f"  #{da['i']} {da['path']} {who}: {da['status']}/{ra} → {db['status']}/{rb}")
+
+    if not diffs:
+        print(f"✅ Sin diferencias en {min(len(a), len(b))} decisiones")
+        return 0
+
+    print(f"❌ {sum(diffs.values())} decisiones distintas:")
+    for (sa, ra, sb, rb), n in diffs.most_common():
+        print(f"  {n:6d}  {sa}/{ra} → {sb}/{rb}")
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay determinista de tráfico capturado")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    run = sub.add_parser("run", help="reproducir capturas contra una versión del código")
+    run.add_argument("captures", nargs="+", help="archivos capture-*.jsonl(.gz)")
+    run.add_argument("--speed", default="max", help="1, N (x veces más rápido) o max")
+    run.add_argument("--app-dir", default=os.path.dirname(os.path.abspath(__file__)),
+                     help="checkout cuyo app.py se prueba")
+    run.add_argument("--state", help="storage.json inicial (por defecto vacío)")
+    run.add_argument("--geo", help="JSON {ip: geo} para el geo simulado")
+    run.add_argument("--out", default="decisions.jsonl")
+
+    diff = sub.add_parser("diff", help="comparar decisiones de dos replays")
+    diff.add_argument("a")
+    diff.add_argument("b")
+    diff.add_argument("--limit", type=int, default=20, help="diferencias a mostrar")
+
+    args = parser.parse_args()
+    if args.cmd == "run":
+        return cmd_run(args)
+    return cmd_diff(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
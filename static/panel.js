@@ -1,42 +1,29 @@
-// ==========================
-// Evento de entrada (LAND)
-// ==========================
-(async () => {
-  await initDevice();
-  sendEvent({
-    type: "land",
-    ts: Date.now(),
-    url: location.href,
-    ref: document.referrer,
-    ua: navigator.userAgent,
-    lang: navigator.language,
-    tz: Intl.DateTimeFormat().resolvedOptions().timeZone,
-    platform: navigator.platform,
-    screen: `${window.screen.width}x${window.screen.height}`
-  });
-})();
-
-
-// ==========================
-// Evento de salida (LEAVE)
-// ==========================
-window.addEventListener("beforeunload", () => {
-  sendEvent({
-    type: "leave",
-    ts: Date.now()
-  });
-});
-
 // ==========================
 // IDENTIFICADOR REAL ÚNICO
 // ==========================
 
 let DEVICE_ID = null;
+let FP_HASH = null;
 
 // *** SALT secreto — cámbialo para ti ***
 const CG_SALT = "MEDIGOENCASA-2025";
 
-async function initDevice() {
+// Fingerprint cacheado: se recalcula solo si cambia la versión o expira
+const FP_CACHE_KEY = "cg_fp_cache";
+const FP_VERSION = 1;
+const FP_TTL_MS = 7 * 24 * 3600 * 1000;
+
+function getPersistentId() {
+  let pid = localStorage.getItem("cg_persistent_id_v2");
+  if (!pid) {
+    pid = crypto.randomUUID();
+    localStorage.setItem("cg_persistent_id_v2", pid);
+  }
+  return pid;
+}
+
+// Síncrono y barato: no toca canvas, así el LAND sale de inmediato
+function initDevice() {
   // 1️⃣ Si ya existe, úsalo
   const stored = localStorage.getItem("cg_device_id_v2");
   if (stored) {
@@ -44,36 +31,25 @@ async function initDevice() {
     return;
   }
 
-  // 2️⃣ Obtener fingerprint base
-  let finger = await getFingerprintBase();
-
-  // 3️⃣ timestamp de instalación
+  // 2️⃣ timestamp de instalación
   let installTs = localStorage.getItem("cg_install_ts_v2");
   if (!installTs) {
     installTs = Date.now().toString();
     localStorage.setItem("cg_install_ts_v2", installTs);
   }
 
-  // 4️⃣ mezcla final
-  const raw = finger + "|" + installTs + "|" + CG_SALT;
-
-  // 5️⃣ hash
+  // 3️⃣ mezcla final — los 38 chars de btoa solo cubren el persistent id,
+  //    así que el ID es el mismo que cuando se mezclaba el fingerprint completo
+  const raw = getPersistentId() + "|" + installTs + "|" + CG_SALT;
   const finalID = "perm-" + btoa(raw).substring(0,38);
 
-  // 6️⃣ guardar
+  // 4️⃣ guardar
   localStorage.setItem("cg_device_id_v2", finalID);
   DEVICE_ID = finalID;
 }
 
 // *** Fingerprint base — NO único pero estable ***
-async function getFingerprintBase(){
-  // persistent para que no cambie
-  let pid = localStorage.getItem("cg_persistent_id_v2");
-  if (!pid) {
-    pid = crypto.randomUUID();
-    localStorage.setItem("cg_persistent_id_v2", pid);
-  }
-
+function getFingerprintBase(){
   // canvas
   const canvas = document.createElement("canvas");
   const ctx = canvas.getContext("2d");
@@ -92,24 +68,72 @@ async function getFingerprintBase(){
     `${screen.width}x${screen.height}`
   ].join("|");
 
-  return pid + "|" + canvasFP.substring(0,40) + "|" + basicRaw;
+  return getPersistentId() + "|" + canvasFP.substring(0,40) + "|" + basicRaw;
+}
+
+async function hashFingerprint(raw) {
+  if (crypto.subtle) {
+    const buf = await crypto.subtle.digest("SHA-256", new TextEncoder().encode(raw + "|" + CG_SALT));
+    return [...new Uint8Array(buf)].map(b => b.toString(16).padStart(2, "0")).join("").substring(0, 32);
+  }
+  return btoa(raw).substring(0, 32);
+}
+
+function loadCachedFingerprint() {
+  try {
+    const c = JSON.parse(localStorage.getItem(FP_CACHE_KEY) || "null");
+    if (!c || c.v !== FP_VERSION) return { hash: null, fresh: false };
+    return { hash: c.hash, fresh: Date.now() < c.exp };
+  } catch (e) {
+    return { hash: null, fresh: false };
+  }
+}
+
+async function refreshFingerprint() {
+  try {
+    const prev = FP_HASH;
+    FP_HASH = await hashFingerprint(getFingerprintBase());
+    localStorage.setItem(FP_CACHE_KEY, JSON.stringify({
+      v: FP_VERSION,
+      hash: FP_HASH,
+      exp: Date.now() + FP_TTL_MS
+    }));
+    // El land ya salió con el cacheado (o sin hash): mandar el fresco ahora
+    if (FP_HASH !== prev) sendFingerprint();
+  } catch (e) {}
+}
+
+function sendFingerprint() {
+  if (!DEVICE_ID) initDevice();
+  const body = JSON.stringify({ device_id: DEVICE_ID, fp_hash: FP_HASH });
+  if (navigator.sendBeacon && navigator.sendBeacon("/track/fp", new Blob([body], { type: "application/json" }))) return;
+  fetch("/track/fp", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body,
+    keepalive: true
+  });
+}
+
+// Recalcular fuera del camino crítico (cuando el navegador esté libre)
+function scheduleFingerprintRefresh() {
+  const run = () => refreshFingerprint();
+  if ("requestIdleCallback" in window) {
+    requestIdleCallback(run, { timeout: 3000 });
+  } else {
+    setTimeout(run, 1500);
+  }
 }
 
 // ==========================
 // SEND EVENT
 // ==========================
-async function sendEvent(data) {
+function sendEvent(data) {
   // asegurar ID
-  if (!DEVICE_ID) {
-    const stored = localStorage.getItem("cg_device_id_v2");
-    if (stored) {
-      DEVICE_ID = stored;
-    } else {
-      await initDevice();
-    }
-  }
+  if (!DEVICE_ID) initDevice();
 
   data.device_id = DEVICE_ID;
+  if (FP_HASH) data.fp_hash = FP_HASH;
 
   fetch("/track", {
     method: "POST",
@@ -118,6 +142,42 @@ async function sendEvent(data) {
     keepalive:true
   });
 }
+
+// ==========================
+// Evento de entrada (LAND)
+// ==========================
+(() => {
+  initDevice();
+
+  // Hash cacheado (puede estar vencido); el fresco se manda aparte a /track/fp
+  const cached = loadCachedFingerprint();
+  FP_HASH = cached.hash;
+
+  sendEvent({
+    type: "land",
+    ts: Date.now(),
+    url: location.href,
+    ref: document.referrer,
+    ua: navigator.userAgent,
+    lang: navigator.language,
+    tz: Intl.DateTimeFormat().resolvedOptions().timeZone,
+    platform: navigator.platform,
+    screen: `${window.screen.width}x${window.screen.height}`
+  });
+
+  if (!cached.fresh) scheduleFingerprintRefresh();
+})();
+
+
+// ==========================
+// Evento de salida (LEAVE)
+// ==========================
+window.addEventListener("beforeunload", () => {
+  sendEvent({
+    type: "leave",
+    ts: Date.now()
+  });
+});
 // ==========================
 // Helpers (riesgo, eventos, origen)
 // ==========================
@@ -171,7 +231,7 @@ async function blockDevice(device_id) {
       body: JSON.stringify({ device_id })
     });
     if (!res.ok) throw new Error();
-    loadData();
+    loadData(true);
   } catch (e) {
     alert("Error al bloquear el dispositivo");
   }
@@ -186,7 +246,7 @@ async function unblockDevice(device_id) {
       body: JSON.stringify({ device_id })
     });
     if (!res.ok) throw new Error();
-    loadData();
+    loadData(true);
   } catch (e) {
     alert("Error al desbloquear el dispositivo");
   }
@@ -200,7 +260,7 @@ async function blockIp(ip) {
       body: JSON.stringify({ ip })
     });
     if (!res.ok) throw new Error();
-    loadData();
+    loadData(true);
   } catch (e) {
     alert("Error al bloquear la IP");
   }
@@ -216,7 +276,7 @@ async function unblockIp(ip) {
       body: JSON.stringify({ ip })
     });
     if (!res.ok) throw new Error();
-    loadData();
+    loadData(true);
   } catch (e) {
     alert("Error al desbloquear la IP");
   }
@@ -262,14 +322,29 @@ function eventKey(r) {
   return (r.ts || "") + "|" + (r.ip || "") + "|" + (r.device_id || "");
 }
 
+// En memoria; se persiste en lotes (debounce) para no reescribir en cada clic
+const HIDDEN = getHiddenSet();
+let hiddenSaveTimer = null;
+
+function saveHiddenSoon() {
+  clearTimeout(hiddenSaveTimer);
+  hiddenSaveTimer = setTimeout(() => {
+    hiddenSaveTimer = null;
+    saveHiddenSet(HIDDEN);
+  }, 1000);
+}
+
+window.addEventListener("beforeunload", () => {
+  if (hiddenSaveTimer) saveHiddenSet(HIDDEN);
+});
+
 // Oculta una fila (solo visual)
 function hideRow(ts, ip, device_id) {
-  const set = getHiddenSet();
   const key = (ts || "") + "|" + (ip || "") + "|" + (device_id || "");
-  set.add(key);
-  saveHiddenSet(set);
-  // volver a pintar la tabla
-  loadData();
+  HIDDEN.add(key);
+  saveHiddenSoon();
+  VIEW = VIEW.filter(k => k !== key);
+  renderWindow();
 }
 
 // ==========================
@@ -368,49 +443,272 @@ function renderRow(r) {
 }
 
 // ==========================
-// Cargar datos
+// Estado del panel (en memoria, índices por evento)
 // ==========================
-async function loadData() {
+const MAX_ROWS = 100000;
+const SERVER_LIMIT = 30000;      // = EVENTS maxlen en el backend (solo carga inicial)
+const FULL_SYNC_EVERY = 12;      // cada ~1 min refresca estado de bloqueo (/api/blocklist)
+const ROW_OVERSCAN = 10;
+
+const ROWS = new Map();          // key → { ev, key, search, score, dwell, sig }
+let ARRIVAL = [];                // keys en orden de llegada (para recortar)
+let ORDER = [];                  // keys ordenadas según SORT
+let VIEW = [];                   // keys filtradas
+let MOUNTED = new Map();         // key → { tr, sig } filas en el DOM
+let SORT = { field: "ts", dir: -1 };
+let LAST_SEQ = null;             // cursor del servidor (seq de EVENTS)
+let BOOT = null;                 // si cambia, el servidor reinició y seq volvió a 1
+let POLLS = 0;
+let ROW_H = 52;
+let ROW_H_MEASURED = false;
+
+const SORTERS = {
+  ts: r => r.ev.ts || "",
+  ip: r => r.ev.ip || "",
+  dwell: r => r.dwell,
+  risk: r => r.score
+};
+
+function indexRow(ev) {
+  return {
+    ev,
+    key: eventKey(ev),
+    search: [ev.ip, ev.device_id, ev.geo?.city, ev.geo?.region, ev.geo?.isp, ev.type, origen(ev)]
+      .map(x => String(x || "").toLowerCase()).join("\u0001"),
+    score: ev.risk?.score || 0,
+    dwell: ev.dwell_ms || 0,
+    sig: (ev.blocked_now ? "1" : "0") + "|" + (ev.blocked_by || "")
+  };
+}
+
+function compareKeys(a, b) {
+  const f = SORTERS[SORT.field];
+  const va = f(ROWS.get(a)), vb = f(ROWS.get(b));
+  return va < vb ? -SORT.dir : va > vb ? SORT.dir : 0;
+}
+
+function sortedIndex(arr, key) {
+  let lo = 0, hi = arr.length;
+  while (lo < hi) {
+    const mid = (lo + hi) >> 1;
+    if (compareKeys(arr[mid], key) <= 0) lo = mid + 1;
+    else hi = mid;
+  }
+  return lo;
+}
+
+function mergeSorted(a, b) {
+  const out = [];
+  let i = 0, j = 0;
+  while (i < a.length && j < b.length) out.push(compareKeys(a[i], b[j]) <= 0 ? a[i++] : b[j++]);
+  while (i < a.length) out.push(a[i++]);
+  while (j < b.length) out.push(b[j++]);
+  return out;
+}
+
+// Agrega/actualiza por clave; devuelve true si algo cambió
+function ingest(events) {
+  const added = [];
+  let changed = false;
+
+  // el backend manda más nuevo primero
+  for (let i = events.length - 1; i >= 0; i--) {
+    const row = indexRow(events[i]);
+    const prev = ROWS.get(row.key);
+    if (prev && prev.sig === row.sig) continue;
+
+    ROWS.set(row.key, row);
+    changed = true;
+    if (!prev) {
+      added.push(row.key);
+      ARRIVAL.push(row.key);
+    }
+  }
+
+  if (added.length) {
+    added.sort(compareKeys);
+    // Pocas filas nuevas (poll normal) → inserción binaria; carga grande → merge
+    if (added.length < 1000) added.forEach(k => ORDER.splice(sortedIndex(ORDER, k), 0, k));
+    else ORDER = mergeSorted(ORDER, added);
+  }
+
+  // Recortar los más viejos (en bloques, no en cada poll)
+  if (ARRIVAL.length > MAX_ROWS * 1.05) {
+    const drop = ARRIVAL.slice(0, ARRIVAL.length - MAX_ROWS);
+    ARRIVAL = ARRIVAL.slice(drop.length);
+    let pruned = false;
+    drop.forEach(k => {
+      ROWS.delete(k);
+      if (HIDDEN.delete(k)) pruned = true;
+    });
+    if (pruned) saveHiddenSoon();
+    ORDER = ORDER.filter(k => ROWS.has(k));
+  }
+  return changed;
+}
+
+function applyFilters() {
   const onlySuspicious = document.getElementById("onlySuspicious").checked;
   const search = (document.getElementById("search").value || "").toLowerCase();
 
+  VIEW = ORDER.filter(k => {
+    if (HIDDEN.has(k)) return false;
+    const r = ROWS.get(k);
+    if (onlySuspicious && r.score < 40) return false;
+    if (search && !r.search.includes(search)) return false;
+    return true;
+  });
+
+  document.getElementById("kpiSummary").innerText = `Total: ${VIEW.length}`;
+  renderWindow();
+}
+
+function setSort(field) {
+  SORT = SORT.field === field ? { field, dir: -SORT.dir } : { field, dir: -1 };
+  ORDER.sort(compareKeys);
+  applyFilters();
+}
+
+// ==========================
+// Render virtualizado: solo las filas visibles (+ overscan)
+// ==========================
+function spacerRow(height) {
+  const tr = document.createElement("tr");
+  tr.className = "spacer";
+  tr.innerHTML = `<td colspan="14" style="padding:0;border:0;height:${height}px"></td>`;
+  return tr;
+}
+
+function buildRow(ev) {
+  const t = document.createElement("tbody");
+  t.innerHTML = renderRow(ev);
+  return t.firstElementChild;
+}
+
+function renderWindow() {
+  const wrap = document.querySelector(".table-wrap");
+  const start = Math.max(0, Math.floor(wrap.scrollTop / ROW_H) - ROW_OVERSCAN);
+  const count = Math.ceil(wrap.clientHeight / ROW_H) + 2 * ROW_OVERSCAN;
+  const keys = VIEW.slice(start, start + count);
+
+  const frag = document.createDocumentFragment();
+  const next = new Map();
+  frag.appendChild(spacerRow(start * ROW_H));
+  for (const k of keys) {
+    const r = ROWS.get(k);
+    let m = MOUNTED.get(k);
+    if (!m || m.sig !== r.sig) m = { tr: buildRow(r.ev), sig: r.sig };
+    next.set(k, m);
+    frag.appendChild(m.tr);
+  }
+  frag.appendChild(spacerRow((VIEW.length - start - keys.length) * ROW_H));
+
+  document.getElementById("tbody").replaceChildren(frag);
+  MOUNTED = next;
+
+  // Medir la altura real de fila una vez
+  if (!ROW_H_MEASURED && keys.length) {
+    const h = MOUNTED.get(keys[0]).tr.offsetHeight;
+    if (h > 0) {
+      ROW_H_MEASURED = true;
+      if (Math.abs(h - ROW_H) > 1) {
+        ROW_H = h;
+        renderWindow();
+      }
+    }
+  }
+}
+
+let scrollFrame = null;
+document.querySelector(".table-wrap").addEventListener("scroll", () => {
+  if (scrollFrame) return;
+  scrollFrame = requestAnimationFrame(() => {
+    scrollFrame = null;
+    renderWindow();
+  });
+});
+
+// Recalcula blocked_now/blocked_by con la lista actual (misma regla que /api/events)
+function applyBlocklist(bl) {
+  const devices = new Set(bl.devices || []);
+  const ips = new Set(bl.ips || []);
+  let changed = false;
+
+  for (const [key, row] of ROWS) {
+    const byDevice = !!row.ev.device_id && devices.has(row.ev.device_id);
+    const byIp = ips.has(row.ev.ip);
+    const blockedBy = byDevice ? "device" : (byIp ? "ip" : null);
+    if (row.sig === (blockedBy ? "1" : "0") + "|" + (blockedBy || "")) continue;
+
+    ROWS.set(key, indexRow({ ...row.ev, blocked_now: !!blockedBy, blocked_by: blockedBy }));
+    changed = true;
+  }
+  return changed;
+}
+
+async function syncBlocklist() {
+  try {
+    const res = await fetch("/api/blocklist");
+    return applyBlocklist(await res.json());
+  } catch (e) {
+    console.error("Error cargando blocklist", e);
+    return false;
+  }
+}
+
+// ==========================
+// Cargar datos (carga inicial + incremental + resync de bloqueos)
+// ==========================
+async function loadData(full = false) {
+  // Solo la primera carga baja la ventana completa; luego `after` + blocklist
+  const initial = LAST_SEQ === null;
+  const resync = !initial && (full === true || ++POLLS % FULL_SYNC_EVERY === 0);
+  const url = initial
+    ? `/api/events?limit=${SERVER_LIMIT}`
+    : `/api/events?limit=${SERVER_LIMIT}&after=${LAST_SEQ}`;
+
   let data = [];
   try {
-    const res = await fetch("/api/events");
+    const res = await fetch(url);
     const json = await res.json();
+    if (!initial && json.boot !== BOOT) {
+      LAST_SEQ = null;   // servidor reiniciado: recargar la ventana
+      return loadData();
+    }
     data = json.events || [];
+    LAST_SEQ = json.last_seq || 0;
+    BOOT = json.boot;
   } catch (e) {
     console.error("Error cargando eventos", e);
+    return;
   }
 
-  // Filtrar sospechosos
-  if (onlySuspicious) {
-    data = data.filter(ev => (ev.risk?.score || 0) >= 40);
-  }
+  let changed = ingest(data);
+  if (resync && await syncBlocklist()) changed = true;
 
-  // Filtrar filas ocultas solo en el panel
-  const hidden = getHiddenSet();
-  data = data.filter(ev => !hidden.has(eventKey(ev)));
-
-  // Buscador
-  if (search) {
-    const s = search;
-    data = data.filter(x =>
-      (x.ip || "").toLowerCase().includes(s) ||
-      (x.device_id || "").toLowerCase().includes(s) ||
-      (x.geo?.city || "").toLowerCase().includes(s) ||
-      (x.geo?.region || "").toLowerCase().includes(s) ||
-      (x.geo?.isp || "").toLowerCase().includes(s) ||
-      (x.type || "").toLowerCase().includes(s) ||
-      origen(x).toLowerCase().includes(s)
-    );
+  // Olvidar ocultos que ya no existen en el servidor
+  if (initial && data.length) {
+    let pruned = false;
+    for (const k of HIDDEN) {
+      if (!ROWS.has(k)) { HIDDEN.delete(k); pruned = true; }
+    }
+    if (pruned) saveHiddenSoon();
   }
 
-  // Pintar tabla
-  document.getElementById("tbody").innerHTML = data.map(renderRow).join("");
-  document.getElementById("kpiSummary").innerText = `Total: ${data.length}`;
+  if (changed || initial) applyFilters();
 }
 
+let filterTimer = null;
+function applyFiltersSoon() {
+  clearTimeout(filterTimer);
+  filterTimer = setTimeout(applyFilters, 150);
+}
+document.getElementById("search").addEventListener("input", applyFiltersSoon);
+document.getElementById("onlySuspicious").addEventListener("change", applyFilters);
+document.querySelectorAll("th[data-sort]").forEach(th => {
+  th.addEventListener("click", () => setSort(th.dataset.sort));
+});
+
 function removeRow(index) {
   const row = document.getElementById("row_" + index);
   if (row) row.remove();
@@ -452,5 +750,5 @@ document.getElementById("zoomOut").onclick = () => map && map.zoomOut();
 // Auto-reload
 // ==========================
 loadData();
-document.getElementById("refresh").onclick = loadData;
+document.getElementById("refresh").onclick = () => loadData(true);
 setInterval(loadData, 5000);